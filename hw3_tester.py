@@ -1,6 +1,10 @@
 # hw3_tester.py
 # Local tester for the tricky cases from HW3
 
+import sys
+import threading
+import time
+
 from music_db import (
     get_connection,
     clear_database,
@@ -12,8 +16,28 @@ from music_db import (
     get_most_rated_songs,
     get_most_engaged_users,
     get_album_and_single_artists,
+    get_watermark,
+    changes_since,
+    get_shard_connections,
+    clear_database_sharded,
+    load_single_songs_sharded,
+    load_albums_sharded,
+    load_users_sharded,
+    load_song_ratings_sharded,
+    get_most_rated_songs_sharded,
+    get_most_engaged_users_sharded,
+    get_replicated_connection,
+    verify_genre_song_counts,
+    rebuild_rating_sketches,
+    startup_report,
 )
 
+# Second local MySQL instance replicating from the primary (gtid_mode=ON).
+REPLICA_ADDRESSES = [("127.0.0.1", 3307)]
+
+# Local schemas standing in for shards; each must be created from music_db.sql.
+SHARD_DATABASES = ["sab541_music_db_shard0", "sab541_music_db_shard1", "sab541_music_db_shard2"]
+
 
 def print_header(title: str):
     print("\n" + "=" * 60)
@@ -21,6 +45,40 @@ def print_header(title: str):
     print("=" * 60)
 
 
+# ---------------------------------------------------------
+# 0) startup – driver import and connect are deferred
+# ---------------------------------------------------------
+
+def test_lazy_startup():
+    print_header("TEST: importing music_db / get_connection stay lazy")
+
+    assert "mysql.connector" not in sys.modules, "Importing music_db should not import the driver"
+
+    conn = get_connection()
+    conn.autocommit = True
+    assert "mysql.connector" not in sys.modules, "get_connection should not connect"
+    conn.close()
+
+    with get_connection() as scoped:
+        scoped.autocommit = False
+    assert "mysql.connector" not in sys.modules, "An unused with block should not connect"
+
+    # Laziness is checked; the driver may be imported from here on
+    import mysql.connector
+
+    # A closed connection must not quietly reopen
+    for closed in (conn, scoped):
+        try:
+            closed.cursor()
+        except mysql.connector.errors.OperationalError as e:
+            print("Use after close raised:", e)
+        else:
+            raise AssertionError("cursor() after close() should raise")
+
+    print(startup_report())
+    print("✅ lazy startup test passed.")
+
+
 # ---------------------------------------------------------
 # 1) load_single_songs – duplicate handling
 # ---------------------------------------------------------
@@ -346,11 +404,372 @@ def test_get_most_engaged_users(mydb):
     print("✅ get_most_engaged_users test passed.")
 
 
+def test_genre_song_counters(mydb):
+    print_header("TEST: GenreSongCount counters match SongGenre")
+
+    setup_for_query_tests(mydb)
+
+    # Repeated genre in one single: INSERT IGNORE skips the second row,
+    # so the counter must only move once
+    load_single_songs(mydb, [("Twice Rock", ("Rock", "Rock"), "Artist D", "2022-01-01")])
+
+    res = get_top_song_genres(mydb, 10)
+    print("get_top_song_genres(10) =", res)
+    assert res == [("Rock", 5), ("Jazz", 2), ("Pop", 1)]
+
+    mismatches = verify_genre_song_counts(mydb)
+    print("verify_genre_song_counts() =", mismatches)
+    assert mismatches == {}
+
+    # Corrupt a counter, then check that verification finds and repairs it
+    cur = mydb.cursor()
+    cur.execute("UPDATE GenreSongCount SET song_count = 99 WHERE name = 'Pop'")
+    mydb.commit()
+    cur.close()
+
+    assert verify_genre_song_counts(mydb, repair=True) == {"Pop": (99, 1)}
+    assert verify_genre_song_counts(mydb) == {}
+    assert get_top_song_genres(mydb, 10) == res
+
+    # Concurrent loaders listing the same genres in opposite orders must
+    # not deadlock on the counter rows
+    errors = []
+
+    def loader(i, genres):
+        conn = get_connection()
+        try:
+            for j in range(5):
+                load_single_songs(conn, [(f"Mix {i}-{j}", genres, "Artist D", "2022-01-01")])
+        except Exception as e:
+            errors.append(e)
+        finally:
+            conn.close()
+
+    threads = [
+        threading.Thread(target=loader, args=(i, ("Rock", "Jazz") if i % 2 else ("Jazz", "Rock")))
+        for i in range(4)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    print("Loader errors:", errors)
+    assert errors == [], "Opposite genre orders should not deadlock"
+
+    mydb.rollback()
+    assert verify_genre_song_counts(mydb) == {}
+    assert get_top_song_genres(mydb, 2) == [("Rock", 25), ("Jazz", 22)]
+
+    print("✅ GenreSongCount counter tests passed.")
+
+
+def test_approximate_mode(mydb):
+    print_header("TEST: approximate get_most_rated_songs / get_most_engaged_users")
+
+    setup_for_query_tests(mydb)
+
+    exact_songs = get_most_rated_songs(mydb, (2021, 2021), 10)
+    approx_songs = get_most_rated_songs(mydb, (2021, 2021), 10, approximate=True)
+    print("approximate get_most_rated_songs =", approx_songs)
+
+    exact_users = get_most_engaged_users(mydb, (2021, 2021), 10)
+    approx_users = get_most_engaged_users(mydb, (2021, 2021), 10, approximate=True)
+    print("approximate get_most_engaged_users =", approx_users)
+
+    # Far fewer items than the sketch capacity: estimates are exact
+    assert approx_songs == exact_songs
+    assert approx_users == exact_users
+    for (_, _, cnt) in approx_songs:
+        assert cnt.error == 0
+
+    # Sketches only cover the requested years
+    assert get_most_rated_songs(mydb, (2019, 2020), 10, approximate=True) == []
+
+    # Open-ended ranges the exact path accepts work here too
+    for year_range in [(2021, 9999), (0, 2021), (-5, 10000)]:
+        assert get_most_rated_songs(mydb, year_range, 10, approximate=True) == exact_songs
+        assert get_most_engaged_users(mydb, year_range, 10, approximate=True) == exact_users
+
+    # Ratings that predate the sketches are recovered by a rebuild
+    cur = mydb.cursor()
+    cur.execute("DELETE FROM RatingHeavyHitter")
+    cur.execute("DELETE FROM RatingSketch")
+    mydb.commit()
+    cur.close()
+    assert get_most_rated_songs(mydb, (2021, 2021), 10, approximate=True) == []
+
+    rebuild_rating_sketches(mydb)
+    assert get_most_rated_songs(mydb, (2021, 2021), 10, approximate=True) == exact_songs
+    assert get_most_engaged_users(mydb, (2021, 2021), 10, approximate=True) == exact_users
+
+    print("✅ approximate mode tests passed.")
+
+
+def test_sketches_concurrent_first_ratings(mydb):
+    print_header("TEST: concurrent loaders creating the same day's sketches")
+
+    setup_for_query_tests(mydb)
+    load_users(mydb, [f"fan{i}" for i in range(8)])
+
+    # Every loader rates on a day no sketch exists for yet
+    errors = []
+
+    def loader(i):
+        conn = get_connection()
+        try:
+            load_song_ratings(conn, [(f"fan{i}", ("Pop Single", "Artist B"), 5, "2023-07-01")])
+        except Exception as e:
+            errors.append(e)
+        finally:
+            conn.close()
+
+    threads = [threading.Thread(target=loader, args=(i,)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    print("Loader errors:", errors)
+    assert errors == [], "Concurrent first ratings of a day should not deadlock"
+
+    mydb.rollback()
+    res = get_most_rated_songs(mydb, (2023, 2023), 1, approximate=True)
+    print("approximate get_most_rated_songs((2023,2023),1) =", res)
+    assert res == [("Pop Single", "Artist B", 8)]
+
+    print("✅ concurrent sketch creation test passed.")
+
+
+# ---------------------------------------------------------
+# 5) changes_since – incremental change feed
+# ---------------------------------------------------------
+
+def test_changes_since(mydb):
+    print_header("TEST: changes_since – only rows loaded after the watermark")
+
+    setup_for_query_tests(mydb)
+
+    watermark = get_watermark(mydb)
+    print("Watermark after setup:", watermark)
+
+    load_single_songs(mydb, [("New Single", ("Pop",), "Artist B", "2022-01-01")])
+    load_song_ratings(mydb, [("carol", ("New Single", "Artist B"), 5, "2022-01-02")])
+
+    changes = [c for batch in changes_since(mydb, watermark, batch_size=1) for c in batch]
+    print("changes_since(watermark) =", changes)
+
+    assert [table for (_, table, _) in changes] == ["Song", "Rating"]
+    assert changes[0][2][1] == "New Single"
+    assert changes[1][2][3] == 5
+    assert all(change_id > watermark for (change_id, _, _) in changes)
+
+    assert list(changes_since(mydb, get_watermark(mydb))) == [], (
+        "Nothing should be returned past the newest watermark"
+    )
+
+    # Clearing must not move the watermark backwards, and must tell
+    # consumers that ids they already hold are now void
+    last = get_watermark(mydb)
+    clear_database(mydb)
+    load_single_songs(mydb, [("After Clear", ("Rock",), "Artist A", "2023-01-01")])
+    assert get_watermark(mydb) > last
+
+    changes = [c for batch in changes_since(mydb, last) for c in batch]
+    print("changes_since(before clear) =", changes)
+    assert [table for (_, table, _) in changes] == ["Reset", "Song"]
+    assert changes[0][2] is None
+
+    print("✅ changes_since test passed.")
+
+
+def test_changes_since_concurrent_loaders(mydb):
+    print_header("TEST: changes_since – no gaps while loaders commit concurrently")
+
+    setup_for_query_tests(mydb)
+    watermark = get_watermark(mydb)
+
+    num_loaders, loads_each = 4, 25
+    expected = {f"Song {t}-{i}" for t in range(num_loaders) for i in range(loads_each)}
+
+    def loader(t):
+        conn = get_connection()
+        try:
+            for i in range(loads_each):
+                load_single_songs(conn, [(f"Song {t}-{i}", ("Rock",), f"Loader {t}", "2022-01-01")])
+        finally:
+            conn.close()
+
+    threads = [threading.Thread(target=loader, args=(t,)) for t in range(num_loaders)]
+    for thread in threads:
+        thread.start()
+
+    # Poll like an incremental consumer while the loaders are still running.
+    # A change committed behind an already-seen watermark would be lost here.
+    seen = set()
+    while True:
+        running = any(thread.is_alive() for thread in threads)
+        mydb.rollback()  # end the read snapshot so new commits are visible
+        for batch in changes_since(mydb, watermark):
+            for change_id, table, row in batch:
+                assert change_id > watermark
+                watermark = change_id
+                if table == "Song":
+                    seen.add(row[1])
+        if not running:
+            break
+
+    for thread in threads:
+        thread.join()
+
+    print(f"Consumer saw {len(seen)} of {len(expected)} songs")
+    assert seen == expected, f"Missing from change feed: {sorted(expected - seen)[:5]}"
+
+    print("✅ changes_since concurrent loader test passed.")
+
+
+# ---------------------------------------------------------
+# 6) sharded Rating storage – scatter-gather top-N
+# ---------------------------------------------------------
+
+def test_sharded_queries(shards):
+    print_header("TEST: sharded load_song_ratings + scatter-gather top-N")
+
+    clear_database_sharded(shards)
+
+    # Same dataset as setup_for_query_tests, loaded through the shard router
+    load_single_songs_sharded(shards, [
+        ("Rock Single", ("Rock",), "Artist A", "2020-01-01"),
+        ("Pop Single", ("Pop",), "Artist B", "2020-02-01"),
+        ("Dual Genre", ("Rock", "Jazz"), "Artist C", "2021-03-01"),
+    ])
+    load_albums_sharded(shards, [
+        ("Rock Album", "Artist A", "Rock", ["Album Rock 1", "Album Rock 2"]),
+        ("Jazz Album", "Artist C", "Jazz", ["Album Jazz 1"]),
+    ])
+    load_users_sharded(shards, ["alice", "bob", "carol"])
+
+    bad = load_song_ratings_sharded(shards, [
+        ("alice", ("Rock Single", "Artist A"), 5, "2021-01-01"),
+        ("bob",   ("Rock Single", "Artist A"), 4, "2021-01-02"),
+        ("alice", ("Pop Single", "Artist B"), 3, "2021-02-01"),
+        ("alice", ("Dual Genre", "Artist C"), 4, "2021-03-01"),
+        ("bob",   ("Dual Genre", "Artist C"), 5, "2021-03-02"),
+        ("carol", ("Dual Genre", "Artist C"), 5, "2021-03-03"),
+        ("carol", ("Album Rock 1", "Artist A"), 4, "2021-04-01"),
+        ("bob",   ("Album Jazz 1", "Artist C"), 4, "2021-05-01"),
+        ("bob",   ("Album Jazz 1", "Artist C"), 2, "2021-05-02"),
+        ("dave",  ("Album Jazz 1", "Artist C"), 2, "2021-05-02"),
+    ])
+    print("Sharded ratings bad set:", bad)
+    assert bad == {("bob", "Album Jazz 1", "Artist C"), ("dave", "Album Jazz 1", "Artist C")}
+
+    songs = get_most_rated_songs_sharded(shards, (2021, 2021), 10)
+    print("get_most_rated_songs_sharded((2021,2021),10) =", songs)
+    assert songs == [
+        ("Dual Genre", "Artist C", 3),
+        ("Rock Single", "Artist A", 2),
+        ("Album Jazz 1", "Artist C", 1),
+        ("Album Rock 1", "Artist A", 1),
+        ("Pop Single", "Artist B", 1),
+    ]
+
+    users = get_most_engaged_users_sharded(shards, (2021, 2021), 2)
+    print("get_most_engaged_users_sharded((2021,2021),2) =", users)
+    assert users == [("alice", 3), ("bob", 3)]
+
+    # A rating batch that fails on one shard must load nothing on any shard,
+    # so that retrying it does not report the other shards' rows as duplicates
+    retry = [
+        ("alice", ("Album Rock 2", "Artist A"), 4, "2022-01-01"),
+        ("bob",   ("Pop Single", "Artist B"), 4, "2022-01-01"),
+        ("carol", ("Rock Single", "Artist A"), 4, "2022-01-01"),
+    ]
+    try:
+        load_song_ratings_sharded(shards, retry + [("alice", ("Album Rock 1", "Artist A"), 3, "2022-02-30")])
+    except Exception as e:
+        print("Sharded rating load with an invalid date raised:", type(e).__name__)
+    else:
+        raise AssertionError("An invalid rating date should fail the sharded load")
+    assert load_song_ratings_sharded(shards, retry) == set(), "Retry should load every rating"
+
+    # A shard whose catalog already differs must fail the whole load, and
+    # the other shards must not keep their copy
+    load_users(shards[1], ["eve"])
+    try:
+        load_users_sharded(shards, ["eve"])
+    except RuntimeError as e:
+        print("Diverged catalog load raised:", e)
+    else:
+        raise AssertionError("Diverging reject sets should raise")
+    assert load_users(shards[0], ["eve"]) == set(), "Shard 0 should have rolled back"
+
+    try:
+        get_most_engaged_users_sharded([], (2021, 2021), 2)
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("An empty shard list should raise ValueError")
+
+    print("✅ sharded query tests passed.")
+
+
+# ---------------------------------------------------------
+# 7) read replicas – routing + read-your-writes
+# ---------------------------------------------------------
+
+def test_replica_routing(routed):
+    print_header("TEST: get_* on replicas with read-your-writes")
+
+    setup_for_query_tests(routed)
+
+    # Every get_* right after a load must already see that load
+    res = get_most_rated_songs(routed, (2021, 2021), 1)
+    print("get_most_rated_songs via replica =", res)
+    assert res == [("Dual Genre", "Artist C", 3)]
+
+    replica = routed.replicas[0]
+    assert routed.reader() is replica, "A caught-up replica should serve reads"
+
+    # Stall the replica's applier
+    stall = replica.cursor()
+    stall.execute("STOP REPLICA SQL_THREAD")
+    other = get_connection()
+    try:
+        # Another client's write is not ours to wait for
+        load_users(other, ["erin"])
+        assert routed.reader() is replica, "Only this session's writes should be awaited"
+
+        # Our own write is: reads must fall back to the primary
+        load_users(routed, ["dave"])
+        load_song_ratings(routed, [("dave", ("Pop Single", "Artist B"), 5, "2021-06-01")])
+        assert routed.reader() is routed.primary, "A lagging replica should be skipped"
+
+        # ...and the replica that just timed out is not waited on again
+        started = time.perf_counter()
+        assert routed.reader() is routed.primary
+        assert time.perf_counter() - started < routed.max_replica_wait, (
+            "A replica that just timed out should not be waited on again"
+        )
+
+        res = get_most_engaged_users(routed, (2021, 2021), 10)
+        print("get_most_engaged_users while replica lags =", res)
+        assert ("dave", 1) in res
+    finally:
+        stall.execute("START REPLICA SQL_THREAD")
+        stall.close()
+        other.close()
+
+    print("✅ replica routing tests passed.")
+
+
 # ---------------------------------------------------------
 # Main
 # ---------------------------------------------------------
 
 if __name__ == "__main__":
+    test_lazy_startup()
+
     mydb = get_connection()
 
     try:
@@ -360,8 +779,42 @@ if __name__ == "__main__":
         test_load_albums_song_duplicates_between_albums(mydb)
         test_load_song_ratings(mydb)
         test_get_top_song_genres(mydb)
+        test_genre_song_counters(mydb)
         test_album_and_single_artists(mydb)
         test_get_most_rated_songs(mydb)
         test_get_most_engaged_users(mydb)
+        test_approximate_mode(mydb)
+        test_sketches_concurrent_first_ratings(mydb)
+        test_changes_since(mydb)
+        test_changes_since_concurrent_loaders(mydb)
     finally:
         mydb.close()
+
+    try:
+        routed = get_replicated_connection(REPLICA_ADDRESSES)
+        # Connections are opened lazily; force it so a missing server skips
+        routed.primary.is_connected()
+        for replica in routed.replicas:
+            replica.is_connected()
+    except Exception as e:
+        print(f"\nSkipping replica tests ({REPLICA_ADDRESSES} not available: {e})")
+    else:
+        try:
+            test_replica_routing(routed)
+        finally:
+            routed.close()
+
+    try:
+        shards = get_shard_connections(SHARD_DATABASES)
+        for shard in shards:
+            shard.is_connected()
+    except Exception as e:
+        print(f"\nSkipping sharded tests ({SHARD_DATABASES} not available: {e})")
+    else:
+        try:
+            test_sharded_queries(shards)
+        finally:
+            for shard in shards:
+                shard.close()
+
+    print("\n" + startup_report())
@@ -1,16 +1,340 @@
-from typing import List, Tuple, Set
-import mysql.connector  
+import time
 
-def get_connection():
-    return mysql.connector.connect(
-        host="127.0.0.1",
-        port=3306,
+_MODULE_IMPORT_STARTED = time.perf_counter()
+
+from array import array
+from datetime import date
+from typing import Callable, Dict, Iterator, List, Optional, Tuple, Set
+import hashlib
+import json
+import struct
+import sys
+import threading
+import uuid
+import zlib
+
+# mysql.connector is imported on first connect, not at module import, so
+# short-lived callers that never reach the database skip its import cost.
+_connector = None
+
+# Cold-start timings in seconds, filled in as each stage first happens.
+STARTUP_PROFILE: Dict[str, object] = {}
+
+# Guards _connector and STARTUP_PROFILE: shard connections are opened from
+# _scatter's worker threads.
+_startup_lock = threading.Lock()
+
+
+def _mysql_connector():
+    """Import mysql.connector on first use and record how long it took."""
+    global _connector
+    with _startup_lock:
+        if _connector is None:
+            started = time.perf_counter()
+            import mysql.connector
+            STARTUP_PROFILE["driver_import_s"] = time.perf_counter() - started
+            STARTUP_PROFILE["c_extension"] = bool(getattr(mysql.connector, "HAVE_CEXT", False))
+            _connector = mysql.connector
+        return _connector
+
+
+def __getattr__(name: str):
+    # `music_db.mysql` used to exist as a side effect of the eager import.
+    if name == "mysql":
+        return sys.modules[_mysql_connector().__name__.rpartition(".")[0]]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+class LazyConnection:
+    """A mysql.connector connection that is only opened on first use.
+
+    cursor() (or any other connection attribute) opens it; commit() and
+    rollback() on a never-opened connection are no-ops, since there is
+    nothing to commit yet. Setting an attribute such as autocommit before
+    then passes it to connect() instead. Once close() has been called, any
+    further use raises like a closed mysql.connector connection instead of
+    reopening. Usable in a with block, which closes it on exit.
+    """
+
+    def __init__(self, **params):
+        self._params = params
+        self._conn = None
+        self._closed = False
+
+    def _check_open(self) -> None:
+        if self._closed:
+            raise _mysql_connector().errors.OperationalError(
+                "MySQL Connection not available (closed)."
+            )
+
+    def _connect(self):
+        self._check_open()
+        if self._conn is None:
+            connector = _mysql_connector()
+            started = time.perf_counter()
+            # Prefer the C extension when it was built; fall back to pure Python.
+            self._conn = connector.connect(
+                use_pure=not STARTUP_PROFILE["c_extension"],
+                **self._params,
+            )
+            elapsed = time.perf_counter() - started
+            with _startup_lock:
+                STARTUP_PROFILE.setdefault("first_connect_s", elapsed)
+                STARTUP_PROFILE["connect_count"] = STARTUP_PROFILE.get("connect_count", 0) + 1
+        return self._conn
+
+    def cursor(self, *args, **kwargs):
+        return self._connect().cursor(*args, **kwargs)
+
+    def commit(self) -> None:
+        self._check_open()
+        if self._conn is not None:
+            self._conn.commit()
+
+    def rollback(self) -> None:
+        self._check_open()
+        if self._conn is not None:
+            self._conn.rollback()
+
+    def close(self) -> None:
+        self._closed = True
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def __enter__(self) -> "LazyConnection":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.close()
+
+    def __getattr__(self, name: str):
+        if name.startswith("_"):
+            # Never connect for private lookups (e.g. during copy/pickle,
+            # before __init__ has set _conn).
+            raise AttributeError(name)
+        return getattr(self._connect(), name)
+
+    def __setattr__(self, name: str, value) -> None:
+        if name.startswith("_"):
+            object.__setattr__(self, name, value)
+            return
+        self._check_open()
+        if self._conn is not None:
+            setattr(self._conn, name, value)
+        else:
+            # autocommit, database, time_zone, ... are all connect() options
+            self._params[name] = value
+
+
+def get_connection(
+    database: str = "sab541_music_db",
+    host: str = "127.0.0.1",
+    port: int = 3306,
+) -> LazyConnection:
+    return LazyConnection(
+        host=host,
+        port=port,
         user="root",
         password="pass",
-        database="sab541_music_db",
+        database=database,
+    )
+
+
+def startup_report() -> str:
+    """One-line summary of STARTUP_PROFILE for cold-start tracking."""
+    def ms(key: str) -> str:
+        seconds = STARTUP_PROFILE.get(key)
+        return "not yet" if seconds is None else f"{seconds * 1000:.1f} ms"
+
+    c_extension = STARTUP_PROFILE.get("c_extension")
+    driver = "" if c_extension is None else (" (C extension)" if c_extension else " (pure Python)")
+    return (
+        f"music_db startup: module import {ms('module_import_s')}, "
+        f"driver import {ms('driver_import_s')}{driver}, "
+        f"first connect {ms('first_connect_s')}"
+    )
+
+
+def record_startup_profile(path: str) -> None:
+    """Append STARTUP_PROFILE as a timestamped JSON line to `path`."""
+    with open(path, "a", encoding="utf-8") as f:
+        f.write(json.dumps({"timestamp": time.time(), **STARTUP_PROFILE}) + "\n")
+
+
+class ReplicatedConnection:
+    """A primary plus read replicas, usable anywhere a `mydb` is accepted.
+
+    load_* and clear_database run on the primary; get_* queries go to the
+    replicas round-robin. After each write the GTID of this session's own
+    transaction is remembered, and a replica is only read from once it has
+    applied it (read-your-writes). Other clients' writes are not waited for.
+    If no replica catches up within `max_replica_wait` seconds the read falls
+    back to the primary, and a replica that timed out is not waited on again
+    for `lag_backoff` seconds. Requires gtid_mode=ON on the primary and
+    replica_preserve_commit_order=ON on the replicas (the default since
+    8.0.27), so applying our latest GTID implies our earlier ones too.
+    """
+
+    def __init__(
+        self,
+        primary,
+        replicas: list,
+        max_replica_wait: float = 0.5,
+        lag_backoff: float = 5.0,
+    ):
+        if max_replica_wait <= 0:
+            # WAIT_FOR_EXECUTED_GTID_SET treats a timeout of 0 as "wait forever"
+            raise ValueError("max_replica_wait must be positive")
+        self.primary = primary
+        self.replicas = list(replicas)
+        self.max_replica_wait = max_replica_wait
+        self.lag_backoff = lag_backoff
+        self._last_write_gtid: Optional[str] = None
+        self._gtid_mode_checked = False
+        self._lagging_until: Dict[int, float] = {}
+        self._next_replica = 0
+
+    def _check_gtid_mode(self) -> None:
+        # Checked on first use rather than in __init__ so that building the
+        # router does not force the (lazy) primary connection open.
+        if self._gtid_mode_checked or not self.replicas:
+            return
+        cur = self.primary.cursor()
+        try:
+            cur.execute("SELECT @@GLOBAL.gtid_mode")
+            (gtid_mode,) = cur.fetchone()
+        finally:
+            cur.close()
+        if gtid_mode != "ON":
+            raise RuntimeError(
+                f"read replicas need gtid_mode=ON on the primary (it is {gtid_mode}); "
+                "without GTIDs read-your-writes cannot be enforced"
+            )
+        self._gtid_mode_checked = True
+
+    def writer(self):
+        """Return the primary, refusing to write if reads can't see it."""
+        self._check_gtid_mode()
+        return self.primary
+
+    def note_write(self) -> None:
+        """Remember the GTID of this session's last committed write.
+
+        mysql.connector does not expose session_track_gtids state, so the
+        GTID is read from this thread's transaction history instead.
+        """
+        self._check_gtid_mode()
+        cur = self.primary.cursor()
+        try:
+            cur.execute(
+                """
+                SELECT GTID
+                FROM performance_schema.events_transactions_history
+                WHERE THREAD_ID = PS_CURRENT_THREAD_ID()
+                  AND STATE = 'COMMITTED'
+                  AND GTID LIKE '%:%'
+                ORDER BY EVENT_ID DESC
+                LIMIT 1
+                """
+            )
+            row = cur.fetchone()
+            if row is None:
+                # Transaction instrumentation is off: fall back to the whole
+                # executed set, which is correct but waits on other clients too.
+                cur.execute("SELECT @@GLOBAL.gtid_executed")
+                row = cur.fetchone()
+        finally:
+            cur.close()
+        self.primary.rollback()  # end the read-only transaction the SELECT opened
+        self._last_write_gtid = row[0] or None
+
+    def reader(self):
+        """Return a connection that has seen every write made through self."""
+        if not self.replicas:
+            return self.primary
+        self._check_gtid_mode()
+
+        order = [
+            (self._next_replica + i) % len(self.replicas)
+            for i in range(len(self.replicas))
+        ]
+        self._next_replica = (self._next_replica + 1) % len(self.replicas)
+
+        # Prefer any replica that is already caught up; otherwise give the
+        # first one not recently seen lagging a bounded wait, then fall back.
+        for index in order:
+            if self._replica_caught_up(self.replicas[index], wait=False):
+                self._lagging_until.pop(index, None)
+                return self.replicas[index]
+
+        now = time.monotonic()
+        for index in order:
+            if self._lagging_until.get(index, 0.0) > now:
+                continue
+            if self._replica_caught_up(self.replicas[index], wait=True):
+                return self.replicas[index]
+            self._lagging_until[index] = time.monotonic() + self.lag_backoff
+            break
+        return self.primary
+
+    def _replica_caught_up(self, replica, wait: bool) -> bool:
+        # Ending the replica's open read transaction first means the query
+        # that follows takes a fresh snapshot instead of a stale one.
+        replica.rollback()
+        if self._last_write_gtid is None:
+            return True
+        cur = replica.cursor()
+        try:
+            if wait:
+                cur.execute(
+                    "SELECT WAIT_FOR_EXECUTED_GTID_SET(%s, %s)",
+                    (self._last_write_gtid, self.max_replica_wait),
+                )
+                (timed_out,) = cur.fetchone()
+                return timed_out == 0
+            cur.execute(
+                "SELECT GTID_SUBSET(%s, @@GLOBAL.gtid_executed)",
+                (self._last_write_gtid,),
+            )
+            (caught_up,) = cur.fetchone()
+            return caught_up == 1
+        finally:
+            cur.close()
+
+    def close(self) -> None:
+        for conn in [self.primary] + self.replicas:
+            conn.close()
+
+
+def get_replicated_connection(
+    replicas: List[Tuple[str, int]],
+    database: str = "sab541_music_db",
+    max_replica_wait: float = 0.5,
+    lag_backoff: float = 5.0,
+) -> ReplicatedConnection:
+    """Connect to the default primary and each (host, port) read replica."""
+    return ReplicatedConnection(
+        get_connection(database),
+        [get_connection(database, host, port) for host, port in replicas],
+        max_replica_wait,
+        lag_backoff,
     )
 
 
+def _writer(mydb):
+    return mydb.writer() if isinstance(mydb, ReplicatedConnection) else mydb
+
+
+def _reader(mydb):
+    return mydb.reader() if isinstance(mydb, ReplicatedConnection) else mydb
+
+
+def _note_write(mydb) -> None:
+    if isinstance(mydb, ReplicatedConnection):
+        mydb.note_write()
+
+
 def _get_or_create_artist(cur, name: str) -> int:
     cur.execute("SELECT artist_id FROM Artist WHERE name = %s", (name,))
     row = cur.fetchone()
@@ -29,6 +353,24 @@ def _get_or_create_genre(cur, name: str) -> int:
     return cur.lastrowid
 
 
+def _bump_genre_song_counts(cur, added: Dict[int, int]) -> None:
+    """Add a loader's new SongGenre rows ({genre_id: n}) to the genre counters.
+
+    One upsert per genre, in genre_id order: each counter row stays locked
+    until commit, so a fixed order keeps concurrent loaders that share
+    genres from deadlocking.
+    """
+    for genre_id in sorted(added):
+        cur.execute(
+            """
+            INSERT INTO GenreSongCount (genre_id, name, song_count)
+            SELECT genre_id, name, %s FROM Genre WHERE genre_id = %s
+            ON DUPLICATE KEY UPDATE song_count = GenreSongCount.song_count + %s
+            """,
+            (added[genre_id], genre_id, added[genre_id]),
+        )
+
+
 def _get_user_id(cur, username: str):
     """Return user_id if user exists, else None."""
     cur.execute("SELECT user_id FROM `User` WHERE username = %s", (username,))
@@ -48,219 +390,314 @@ def _get_song_id(cur, title: str, artist_name: str):
     return row[0] if row else None
 
 
+def _publish_changes(cur, changes: List[Tuple[str, int]]) -> None:
+    """Write a loader's (table_name, row_id) changes to ChangeLog.
+
+    Call right before commit. change_ids come from the single ChangeSequence
+    row, locked FOR UPDATE until the commit, so ids are handed out in commit
+    order: once a consumer sees change_id N committed, no transaction can
+    still commit an id below N. (AUTO_INCREMENT ids are assigned at insert
+    time and would let a slow loader commit behind a consumer's watermark.)
+    """
+    if not changes:
+        return
+    cur.execute("SELECT next_change_id FROM ChangeSequence WHERE id = 1 FOR UPDATE")
+    (next_change_id,) = cur.fetchone()
+    cur.executemany(
+        "INSERT INTO ChangeLog (change_id, table_name, row_id) VALUES (%s, %s, %s)",
+        [
+            (next_change_id + i, table_name, row_id)
+            for i, (table_name, row_id) in enumerate(changes)
+        ],
+    )
+    cur.execute(
+        "UPDATE ChangeSequence SET next_change_id = %s WHERE id = 1",
+        (next_change_id + len(changes),),
+    )
+
+
+# table_name -> (key column, SELECT returning the row streamed by changes_since)
+_CHANGE_QUERIES = {
+    "Song": (
+        "song_id",
+        "SELECT song_id, title, artist_id, album_id, single_release_date FROM Song",
+    ),
+    "Album": (
+        "album_id",
+        "SELECT album_id, title, artist_id, release_date, genre_id FROM Album",
+    ),
+    "Rating": (
+        "rating_id",
+        "SELECT rating_id, user_id, song_id, rating_value, rating_date FROM Rating",
+    ),
+}
+
+
 def clear_database(mydb) -> None:
-    cur = mydb.cursor()
+    conn = _writer(mydb)
+    cur = conn.cursor()
     try:
         cur.execute("SET FOREIGN_KEY_CHECKS = 0")
-        for table in ["Rating", "SongGenre", "Song", "Album", "`User`", "Genre", "Artist"]:
+        for table in ["RatingSketch", "RatingHeavyHitter", "Rating", "GenreSongCount", "SongGenre", "Song", "Album", "`User`", "Genre", "Artist"]:
             cur.execute(f"TRUNCATE TABLE {table}")
+        # The truncated tables restart their ids at 1, so old log entries would
+        # now point at different rows. Drop them and publish a Reset event;
+        # ChangeSequence is left alone so watermarks keep increasing.
+        cur.execute("DELETE FROM ChangeLog")
         cur.execute("SET FOREIGN_KEY_CHECKS = 1")
-        mydb.commit()
+        _publish_changes(cur, [("Reset", 0)])
+        conn.commit()
+        _note_write(mydb)
     finally:
         cur.close()
 
 
-def load_single_songs(
-    mydb,
+def _run_loader(mydb, body: Callable, rows: list) -> set:
+    """Run a loader body in one transaction on the primary and commit it."""
+    conn = _writer(mydb)
+    cur = conn.cursor()
+    try:
+        bad = body(cur, rows)
+        conn.commit()
+        _note_write(mydb)
+    finally:
+        cur.close()
+
+    return bad
+
+
+def _load_single_songs(
+    cur,
     single_songs: List[Tuple[str, Tuple[str, ...], str, str]]
 ) -> Set[Tuple[str, str]]:
-
+    """Loader body for load_single_songs; the caller owns the transaction."""
     bad: Set[Tuple[str, str]] = set()
-    cur = mydb.cursor()
-    try:
-        for song_title, genres, artist_name, release_date in single_songs:
-            if not genres:
-                bad.add((song_title, artist_name))
-                continue
+    changes: List[Tuple[str, int]] = []
+    genre_added: Dict[int, int] = {}
+    for song_title, genres, artist_name, release_date in single_songs:
+        if not genres:
+            bad.add((song_title, artist_name))
+            continue
 
-            artist_id = _get_or_create_artist(cur, artist_name)
+        artist_id = _get_or_create_artist(cur, artist_name)
 
-            cur.execute(
-                """
-                SELECT song_id FROM Song
-                WHERE title = %s AND artist_id = %s
-                """,
-                (song_title, artist_id),
-            )
-            row = cur.fetchone()
-            if row:
-                bad.add((song_title, artist_name))
-                continue
+        cur.execute(
+            """
+            SELECT song_id FROM Song
+            WHERE title = %s AND artist_id = %s
+            """,
+            (song_title, artist_id),
+        )
+        row = cur.fetchone()
+        if row:
+            bad.add((song_title, artist_name))
+            continue
+
+        cur.execute(
+            """
+            INSERT INTO Song (title, artist_id, album_id, single_release_date)
+            VALUES (%s, %s, NULL, %s)
+            """,
+            (song_title, artist_id, release_date),
+        )
+        song_id = cur.lastrowid
+        changes.append(("Song", song_id))
 
+        for g in genres:
+            genre_id = _get_or_create_genre(cur, g)
             cur.execute(
                 """
-                INSERT INTO Song (title, artist_id, album_id, single_release_date)
-                VALUES (%s, %s, NULL, %s)
+                INSERT IGNORE INTO SongGenre (song_id, genre_id)
+                VALUES (%s, %s)
                 """,
-                (song_title, artist_id, release_date),
+                (song_id, genre_id),
             )
-            song_id = cur.lastrowid
+            if cur.rowcount:
+                genre_added[genre_id] = genre_added.get(genre_id, 0) + 1
 
-            for g in genres:
-                genre_id = _get_or_create_genre(cur, g)
-                cur.execute(
-                    """
-                    INSERT IGNORE INTO SongGenre (song_id, genre_id)
-                    VALUES (%s, %s)
-                    """,
-                    (song_id, genre_id),
-                )
-
-        mydb.commit()
-    finally:
-        cur.close()
+    _bump_genre_song_counts(cur, genre_added)
+    _publish_changes(cur, changes)
 
     return bad
 
 
-def load_albums(
+def load_single_songs(
     mydb,
-    albums: List[Tuple[str, str, str, List[str]]]
+    single_songs: List[Tuple[str, Tuple[str, ...], str, str]]
 ) -> Set[Tuple[str, str]]:
 
+    return _run_loader(mydb, _load_single_songs, single_songs)
+
+
+def _load_albums(
+    cur,
+    albums: List[Tuple[str, str, str, List[str]]]
+) -> Set[Tuple[str, str]]:
+    """Loader body for load_albums; the caller owns the transaction."""
     bad: Set[Tuple[str, str]] = set()
-    cur = mydb.cursor()
-    try:
-        for album_title, artist_name, album_genre, song_titles in albums:
-            artist_id = _get_or_create_artist(cur, artist_name)
-            genre_id = _get_or_create_genre(cur, album_genre)
+    changes: List[Tuple[str, int]] = []
+    genre_added: Dict[int, int] = {}
+    for album_title, artist_name, album_genre, song_titles in albums:
+        artist_id = _get_or_create_artist(cur, artist_name)
+        genre_id = _get_or_create_genre(cur, album_genre)
+
+        cur.execute(
+            """
+            SELECT album_id FROM Album
+            WHERE artist_id = %s AND title = %s
+            """,
+            (artist_id, album_title),
+        )
+        row = cur.fetchone()
+        if row:
+            bad.add((artist_name, album_title))
+            continue
 
+        duplicate_song_found = False
+        for song_title in song_titles:
             cur.execute(
                 """
-                SELECT album_id FROM Album
-                WHERE artist_id = %s AND title = %s
+                SELECT song_id FROM Song
+                WHERE title = %s AND artist_id = %s
                 """,
-                (artist_id, album_title),
+                (song_title, artist_id),
             )
-            row = cur.fetchone()
-            if row:
-                bad.add((artist_name, album_title))
-                continue
+            if cur.fetchone():
+                duplicate_song_found = True
+                break
 
-            duplicate_song_found = False
-            for song_title in song_titles:
-                cur.execute(
-                    """
-                    SELECT song_id FROM Song
-                    WHERE title = %s AND artist_id = %s
-                    """,
-                    (song_title, artist_id),
-                )
-                if cur.fetchone():
-                    duplicate_song_found = True
-                    break
+        if duplicate_song_found:
+            bad.add((artist_name, album_title))
+            continue
 
-            if duplicate_song_found:
-                bad.add((artist_name, album_title))
-                continue
+        cur.execute(
+            """
+            INSERT INTO Album (title, artist_id, release_date, genre_id)
+            VALUES (%s, %s, NULL, %s)
+            """,
+            (album_title, artist_id, genre_id),
+        )
+        album_id = cur.lastrowid
+        changes.append(("Album", album_id))
 
+        for song_title in song_titles:
             cur.execute(
                 """
-                INSERT INTO Album (title, artist_id, release_date, genre_id)
-                VALUES (%s, %s, NULL, %s)
+                INSERT INTO Song (title, artist_id, album_id, single_release_date)
+                VALUES (%s, %s, %s, NULL)
                 """,
-                (album_title, artist_id, genre_id),
+                (song_title, artist_id, album_id),
             )
-            album_id = cur.lastrowid
-
-            for song_title in song_titles:
-                cur.execute(
-                    """
-                    INSERT INTO Song (title, artist_id, album_id, single_release_date)
-                    VALUES (%s, %s, %s, NULL)
-                    """,
-                    (song_title, artist_id, album_id),
-                )
-                song_id = cur.lastrowid
+            song_id = cur.lastrowid
+            changes.append(("Song", song_id))
 
-                cur.execute(
-                    """
-                    INSERT IGNORE INTO SongGenre (song_id, genre_id)
-                    VALUES (%s, %s)
-                    """,
-                    (song_id, genre_id),
-                )
+            cur.execute(
+                """
+                INSERT IGNORE INTO SongGenre (song_id, genre_id)
+                VALUES (%s, %s)
+                """,
+                (song_id, genre_id),
+            )
+            if cur.rowcount:
+                genre_added[genre_id] = genre_added.get(genre_id, 0) + 1
 
-        mydb.commit()
-    finally:
-        cur.close()
+    _bump_genre_song_counts(cur, genre_added)
+    _publish_changes(cur, changes)
 
     return bad
 
 
+def load_albums(
+    mydb,
+    albums: List[Tuple[str, str, str, List[str]]]
+) -> Set[Tuple[str, str]]:
+
+    return _run_loader(mydb, _load_albums, albums)
 
-def load_users(mydb, users: List[str]) -> Set[str]:
 
+
+def _load_users(cur, users: List[str]) -> Set[str]:
+    """Loader body for load_users; the caller owns the transaction."""
     bad: Set[str] = set()
-    cur = mydb.cursor()
-    try:
-        for username in users:
-            cur.execute("SELECT user_id FROM `User` WHERE username = %s", (username,))
-            row = cur.fetchone()
-            if row:
-                bad.add(username)
-                continue
-            cur.execute(
-                "INSERT INTO `User` (username) VALUES (%s)",
-                (username,),
-            )
-        mydb.commit()
-    finally:
-        cur.close()
+    for username in users:
+        cur.execute("SELECT user_id FROM `User` WHERE username = %s", (username,))
+        row = cur.fetchone()
+        if row:
+            bad.add(username)
+            continue
+        cur.execute(
+            "INSERT INTO `User` (username) VALUES (%s)",
+            (username,),
+        )
 
     return bad
 
 
-def load_song_ratings(
-    mydb,
+def load_users(mydb, users: List[str]) -> Set[str]:
+
+    return _run_loader(mydb, _load_users, users)
+
+
+def _load_song_ratings(
+    cur,
     song_ratings: List[Tuple[str, Tuple[str, str], int, str]]
 ) -> Set[Tuple[str, str, str]]:
-
+    """Loader body for load_song_ratings; the caller owns the transaction."""
     bad: Set[Tuple[str, str, str]] = set()
-    cur = mydb.cursor()
-    try:
-        for username, (song_title, artist_name), rating_value, rating_date in song_ratings:
-            key = (username, song_title, artist_name)
+    inserted: List[Tuple[str, int, int]] = []
+    changes: List[Tuple[str, int]] = []
+    for username, (song_title, artist_name), rating_value, rating_date in song_ratings:
+        key = (username, song_title, artist_name)
 
-            if rating_value < 1 or rating_value > 5:
-                bad.add(key)
-                continue
+        if rating_value < 1 or rating_value > 5:
+            bad.add(key)
+            continue
 
-            user_id = _get_user_id(cur, username)
-            if user_id is None:
-                bad.add(key)
-                continue
+        user_id = _get_user_id(cur, username)
+        if user_id is None:
+            bad.add(key)
+            continue
 
-            song_id = _get_song_id(cur, song_title, artist_name)
-            if song_id is None:
-                bad.add(key)
-                continue
+        song_id = _get_song_id(cur, song_title, artist_name)
+        if song_id is None:
+            bad.add(key)
+            continue
 
-            cur.execute(
-                """
-                SELECT rating_id FROM Rating
-                WHERE user_id = %s AND song_id = %s
-                """,
-                (user_id, song_id),
-            )
-            if cur.fetchone():
-                bad.add(key)
-                continue
+        cur.execute(
+            """
+            SELECT rating_id FROM Rating
+            WHERE user_id = %s AND song_id = %s
+            """,
+            (user_id, song_id),
+        )
+        if cur.fetchone():
+            bad.add(key)
+            continue
 
-            cur.execute(
-                """
-                INSERT INTO Rating (user_id, song_id, rating_value, rating_date)
-                VALUES (%s, %s, %s, %s)
-                """,
-                (user_id, song_id, rating_value, rating_date),
-            )
+        cur.execute(
+            """
+            INSERT INTO Rating (user_id, song_id, rating_value, rating_date)
+            VALUES (%s, %s, %s, %s)
+            """,
+            (user_id, song_id, rating_value, rating_date),
+        )
+        changes.append(("Rating", cur.lastrowid))
+        inserted.append((str(rating_date), song_id, user_id))
 
-        mydb.commit()
-    finally:
-        cur.close()
+    _update_rating_sketches(cur, inserted)
+    _publish_changes(cur, changes)
 
     return bad
 
+
+def load_song_ratings(
+    mydb,
+    song_ratings: List[Tuple[str, Tuple[str, str], int, str]]
+) -> Set[Tuple[str, str, str]]:
+
+    return _run_loader(mydb, _load_song_ratings, song_ratings)
+
+
 def get_most_prolific_individual_artists(
     mydb,
     n: int,
@@ -268,7 +705,7 @@ def get_most_prolific_individual_artists(
 ) -> List[Tuple[str, int]]:
   
     start_year, end_year = year_range
-    cur = mydb.cursor()
+    cur = _reader(mydb).cursor()
     try:
         sql = """
             SELECT a.name,
@@ -297,7 +734,7 @@ def get_most_prolific_individual_artists(
 
 def get_artists_last_single_in_year(mydb, year: int) -> Set[str]:
 
-    cur = mydb.cursor()
+    cur = _reader(mydb).cursor()
     try:
         sql = """
             SELECT a.name
@@ -321,15 +758,15 @@ def get_top_song_genres(
     n: int
 ) -> List[Tuple[str, int]]:
   
-    cur = mydb.cursor()
+    # Reads the loader-maintained counters; the (song_count DESC, name) index
+    # makes this an index range scan of n rows instead of a SongGenre GROUP BY.
+    cur = _reader(mydb).cursor()
     try:
         sql = """
-            SELECT g.name,
-                   COUNT(DISTINCT sg.song_id) AS cnt
-            FROM Genre g
-            JOIN SongGenre sg ON g.genre_id = sg.genre_id
-            GROUP BY g.genre_id
-            ORDER BY cnt DESC, g.name ASC
+            SELECT name, song_count
+            FROM GenreSongCount
+            WHERE song_count > 0
+            ORDER BY song_count DESC, name ASC
             LIMIT %s
         """
         cur.execute(sql, (n,))
@@ -339,9 +776,60 @@ def get_top_song_genres(
         cur.close()
 
 
+def verify_genre_song_counts(
+    mydb,
+    repair: bool = False
+) -> Dict[str, Tuple[int, int]]:
+    """Compare GenreSongCount against SongGenre.
+
+    Returns {genre name: (stored count, actual count)} for every genre that
+    disagrees. With repair=True the counters are rebuilt from SongGenre.
+    """
+    cur = _reader(mydb).cursor()
+    try:
+        cur.execute(
+            """
+            SELECT g.name,
+                   COALESCE(c.song_count, 0),
+                   COUNT(DISTINCT sg.song_id)
+            FROM Genre g
+            LEFT JOIN GenreSongCount c ON c.genre_id = g.genre_id
+            LEFT JOIN SongGenre sg ON sg.genre_id = g.genre_id
+            GROUP BY g.genre_id, c.song_count
+            HAVING COALESCE(c.song_count, 0) <> COUNT(DISTINCT sg.song_id)
+            """
+        )
+        mismatches = {
+            name: (int(stored), int(actual)) for (name, stored, actual) in cur.fetchall()
+        }
+    finally:
+        cur.close()
+
+    if repair and mismatches:
+        conn = _writer(mydb)
+        cur = conn.cursor()
+        try:
+            cur.execute("DELETE FROM GenreSongCount")
+            cur.execute(
+                """
+                INSERT INTO GenreSongCount (genre_id, name, song_count)
+                SELECT g.genre_id, g.name, COUNT(DISTINCT sg.song_id)
+                FROM Genre g
+                JOIN SongGenre sg ON sg.genre_id = g.genre_id
+                GROUP BY g.genre_id
+                """
+            )
+            conn.commit()
+            _note_write(mydb)
+        finally:
+            cur.close()
+
+    return mismatches
+
+
 def get_album_and_single_artists(mydb) -> Set[str]:
 
-    cur = mydb.cursor()
+    cur = _reader(mydb).cursor()
     try:
         sql = """
             SELECT DISTINCT a.name
@@ -363,11 +851,15 @@ def get_album_and_single_artists(mydb) -> Set[str]:
 def get_most_rated_songs(
     mydb,
     year_range: Tuple[int, int],
-    n: int
+    n: int,
+    approximate: bool = False
 ) -> List[Tuple[str, str, int]]:
   
+    if approximate:
+        return _approximate_most_rated_songs(mydb, year_range, n)
+
     start_year, end_year = year_range
-    cur = mydb.cursor()
+    cur = _reader(mydb).cursor()
     try:
         sql = """
             SELECT s.title,
@@ -391,11 +883,15 @@ def get_most_rated_songs(
 def get_most_engaged_users(
     mydb,
     year_range: Tuple[int, int],
-    n: int
+    n: int,
+    approximate: bool = False
 ) -> List[Tuple[str, int]]:
   
+    if approximate:
+        return _approximate_most_engaged_users(mydb, year_range, n)
+
     start_year, end_year = year_range
-    cur = mydb.cursor()
+    cur = _reader(mydb).cursor()
     try:
         sql = """
             SELECT u.username,
@@ -412,3 +908,726 @@ def get_most_engaged_users(
         return [(username, int(cnt)) for (username, cnt) in rows]
     finally:
         cur.close()
+
+
+def get_watermark(mydb) -> int:
+    """Return the id of the newest committed change-feed entry (0 if there is none)."""
+    cur = _reader(mydb).cursor()
+    try:
+        cur.execute("SELECT COALESCE(MAX(change_id), 0) FROM ChangeLog")
+        (watermark,) = cur.fetchone()
+        return int(watermark)
+    finally:
+        cur.close()
+
+
+def changes_since(
+    mydb,
+    watermark: int,
+    batch_size: int = 1000
+) -> Iterator[List[Tuple[int, str, tuple]]]:
+    """Stream Song/Album/Rating rows committed after `watermark`, in commit order.
+
+    Yields batches of (change_id, table_name, row); pass the last change_id
+    seen back in as the next watermark. Only the ChangeLog range past the
+    watermark is scanned, so a run costs O(new rows), not O(table size).
+
+    A (change_id, "Reset", None) entry means clear_database ran: every id
+    seen before it is void and consumers should drop state built from them.
+    """
+    cur = _reader(mydb).cursor()
+    try:
+        while True:
+            cur.execute(
+                """
+                SELECT change_id, table_name, row_id
+                FROM ChangeLog
+                WHERE change_id > %s
+                ORDER BY change_id
+                LIMIT %s
+                """,
+                (watermark, batch_size),
+            )
+            log = cur.fetchall()
+            if not log:
+                return
+
+            ids_by_table = {}
+            for _, table_name, row_id in log:
+                if table_name in _CHANGE_QUERIES:
+                    ids_by_table.setdefault(table_name, []).append(row_id)
+
+            rows = {("Reset", 0): None}
+            for table_name, ids in ids_by_table.items():
+                key, select = _CHANGE_QUERIES[table_name]
+                placeholders = ", ".join(["%s"] * len(ids))
+                cur.execute(f"{select} WHERE {key} IN ({placeholders})", ids)
+                for row in cur.fetchall():
+                    rows[(table_name, row[0])] = row
+
+            # Rows removed since they were logged (e.g. by a cascade) are skipped.
+            batch = [
+                (change_id, table_name, rows[(table_name, row_id)])
+                for change_id, table_name, row_id in log
+                if (table_name, row_id) in rows
+            ]
+            if batch:
+                yield batch
+
+            if len(log) < batch_size:
+                return
+            watermark = log[-1][0]
+    finally:
+        cur.close()
+
+
+# ---------------------------------------------------------
+# Sharding: Rating partitioned by user, catalog replicated
+# ---------------------------------------------------------
+
+def get_shard_connections(databases: List[str]) -> list:
+    """Open one connection per shard schema; list order is the shard number."""
+    if not databases:
+        raise ValueError("at least one shard database is required")
+    return [get_connection(database) for database in databases]
+
+
+def _shard_for_user(username: str, num_shards: int) -> int:
+    # crc32 rather than hash(): str hashing is randomized per process, and
+    # the placement must be identical for every loader and reader.
+    return zlib.crc32(username.encode("utf-8")) % num_shards
+
+
+def _scatter(shards: list, fn: Callable, args_per_shard: list) -> list:
+    """Run fn(shard, *args) on every shard in parallel; results in shard order.
+
+    Each connection is only ever used by one worker thread at a time.
+    """
+    if not shards:
+        raise ValueError("at least one shard is required")
+
+    # Imported here so single-database callers don't pay for it at startup.
+    from concurrent.futures import ThreadPoolExecutor
+
+    with ThreadPoolExecutor(max_workers=len(shards)) as pool:
+        futures = [
+            pool.submit(fn, shard, *args)
+            for shard, args in zip(shards, args_per_shard)
+        ]
+        return [f.result() for f in futures]
+
+
+def _xa_prepare(shard, xid: str, body: Callable, rows: list):
+    """Run a loader body on one shard inside XA transaction `xid` and prepare it.
+
+    Returns the body's rejects, or the exception raised (with the branch
+    rolled back) so the caller can see every shard's outcome before deciding.
+    """
+    try:
+        conn = _writer(shard)
+        conn.rollback()  # XA START needs no transaction to be open
+        cur = conn.cursor()
+    except Exception as e:
+        return e
+    try:
+        cur.execute("XA START %s", (xid,))
+        bad = body(cur, rows)
+        cur.execute("XA END %s", (xid,))
+        cur.execute("XA PREPARE %s", (xid,))
+        return bad
+    except Exception as e:
+        for statement in ("XA END %s", "XA ROLLBACK %s"):
+            try:
+                cur.execute(statement, (xid,))
+            except Exception:
+                pass  # already ended, or the server dropped the branch with the connection
+        return e
+    finally:
+        cur.close()
+
+
+def _xa_finish(shard, xid: str, action: str) -> None:
+    """XA COMMIT or XA ROLLBACK a branch prepared by _xa_prepare."""
+    cur = _writer(shard).cursor()
+    try:
+        cur.execute(f"XA {action} %s", (xid,))
+    finally:
+        cur.close()
+    if action == "COMMIT":
+        _note_write(shard)
+
+
+def _two_phase(
+    shards: list,
+    body: Callable,
+    rows_per_shard: list,
+    check: Optional[Callable] = None,
+) -> list:
+    """Run body(cur, rows) on each shard as one XA transaction; return the outcomes.
+
+    Every shard runs its rows and prepares; only when all prepared (and
+    `check`, if given, returns no error for the outcomes) is each one
+    committed. Otherwise every prepared branch is rolled back and the error
+    raised, so no shard keeps a partial load. A failure during the commit
+    phase itself leaves that shard's branch prepared; it survives restarts
+    and can be finished by hand with XA RECOVER / XA COMMIT.
+    """
+    xid = f"music_db-{uuid.uuid4().hex}"
+    outcomes = _scatter(shards, _xa_prepare, [(xid, body, rows) for rows in rows_per_shard])
+
+    prepared = [
+        shard for shard, outcome in zip(shards, outcomes)
+        if not isinstance(outcome, Exception)
+    ]
+    errors = [outcome for outcome in outcomes if isinstance(outcome, Exception)]
+    error = errors[0] if errors else (check(outcomes) if check else None)
+    if error is not None:
+        if prepared:
+            _scatter(prepared, _xa_finish, [(xid, "ROLLBACK")] * len(prepared))
+        raise error
+
+    _scatter(shards, _xa_finish, [(xid, "COMMIT")] * len(shards))
+    return outcomes
+
+
+def _diverged_rejects(outcomes: list) -> Optional[Exception]:
+    if any(outcome != outcomes[0] for outcome in outcomes):
+        return RuntimeError(
+            f"shards rejected different rows, catalogs have diverged: {outcomes}"
+        )
+    return None
+
+
+def _replicate(shards: list, body: Callable, rows: list) -> set:
+    """Apply a catalog loader body to every shard, atomically across shards.
+
+    Every shard holds the same catalog and applies the same rows, so the
+    rejects must match; if they don't, nothing is committed anywhere.
+    """
+    return _two_phase(shards, body, [rows] * len(shards), _diverged_rejects)[0]
+
+
+def clear_database_sharded(shards: list) -> None:
+    _scatter(shards, clear_database, [()] * len(shards))
+
+
+def load_single_songs_sharded(
+    shards: list,
+    single_songs: List[Tuple[str, Tuple[str, ...], str, str]]
+) -> Set[Tuple[str, str]]:
+    return _replicate(shards, _load_single_songs, single_songs)
+
+
+def load_albums_sharded(
+    shards: list,
+    albums: List[Tuple[str, str, str, List[str]]]
+) -> Set[Tuple[str, str]]:
+    return _replicate(shards, _load_albums, albums)
+
+
+def load_users_sharded(shards: list, users: List[str]) -> Set[str]:
+    return _replicate(shards, _load_users, users)
+
+
+def load_song_ratings_sharded(
+    shards: list,
+    song_ratings: List[Tuple[str, Tuple[str, str], int, str]]
+) -> Set[Tuple[str, str, str]]:
+    """Route each rating to its rater's shard and load the partitions in parallel.
+
+    Shards are chosen by username rather than user_id: the User table is
+    replicated by name, and its AUTO_INCREMENT ids are not guaranteed to
+    line up across shards. All ratings by one user land on one shard, so the
+    per-shard duplicate check is still global. The partitions commit with
+    two-phase commit, so a failure on one shard loads nothing anywhere and
+    the batch can simply be retried.
+    """
+    if not shards:
+        raise ValueError("at least one shard is required")
+    partitions = [[] for _ in shards]
+    for rating in song_ratings:
+        partitions[_shard_for_user(rating[0], len(shards))].append(rating)
+
+    targets = [(shard, rows) for shard, rows in zip(shards, partitions) if rows]
+    if not targets:
+        return set()
+
+    bad: Set[Tuple[str, str, str]] = set()
+    for shard_bad in _two_phase(
+        [shard for shard, _ in targets],
+        _load_song_ratings,
+        [rows for _, rows in targets],
+    ):
+        bad |= shard_bad
+    return bad
+
+
+# Ties are merged by WEIGHT_STRING(), the byte key MySQL itself sorts by
+# under the column's collation, so case- and accent-insensitive ordering
+# matches the single-database queries exactly.
+
+def _rating_counts_by_song(mydb, year_range: Tuple[int, int]) -> list:
+    """Partial (un-limited) per-song counts: (title, artist, cnt, title key, artist key)."""
+    start_year, end_year = year_range
+    cur = _reader(mydb).cursor()
+    try:
+        sql = """
+            SELECT s.title,
+                   a.name,
+                   COUNT(r.rating_id) AS cnt,
+                   WEIGHT_STRING(s.title),
+                   WEIGHT_STRING(a.name)
+            FROM Rating r
+            JOIN Song s ON r.song_id = s.song_id
+            JOIN Artist a ON s.artist_id = a.artist_id
+            WHERE YEAR(r.rating_date) BETWEEN %s AND %s
+            GROUP BY r.song_id
+        """
+        cur.execute(sql, (start_year, end_year))
+        rows = cur.fetchall()
+        return [
+            (title, artist_name, int(cnt), bytes(title_key), bytes(artist_key))
+            for (title, artist_name, cnt, title_key, artist_key) in rows
+        ]
+    finally:
+        cur.close()
+
+
+def _rating_counts_by_user(mydb, year_range: Tuple[int, int], n: int) -> list:
+    """This shard's top-n users: (username, cnt, username key)."""
+    start_year, end_year = year_range
+    cur = _reader(mydb).cursor()
+    try:
+        sql = """
+            SELECT u.username,
+                   COUNT(r.rating_id) AS cnt,
+                   WEIGHT_STRING(u.username)
+            FROM Rating r
+            JOIN `User` u ON r.user_id = u.user_id
+            WHERE YEAR(r.rating_date) BETWEEN %s AND %s
+            GROUP BY u.user_id
+            ORDER BY cnt DESC, u.username ASC
+            LIMIT %s
+        """
+        cur.execute(sql, (start_year, end_year, n))
+        rows = cur.fetchall()
+        return [(username, int(cnt), bytes(key)) for (username, cnt, key) in rows]
+    finally:
+        cur.close()
+
+
+def get_most_rated_songs_sharded(
+    shards: list,
+    year_range: Tuple[int, int],
+    n: int
+) -> List[Tuple[str, str, int]]:
+    """Exact global top-n songs; same result and tie-break as get_most_rated_songs.
+
+    A song's ratings are spread over every shard, so a per-shard top-n could
+    miss the global winners; each shard returns its full partial counts
+    instead and they are summed here.
+    """
+    totals = {}
+    sort_keys = {}
+    for partial in _scatter(shards, _rating_counts_by_song, [(year_range,)] * len(shards)):
+        for title, artist_name, cnt, title_key, artist_key in partial:
+            totals[(title, artist_name)] = totals.get((title, artist_name), 0) + cnt
+            sort_keys[(title, artist_name)] = (title_key, artist_key)
+
+    ranked = sorted(totals.items(), key=lambda item: (-item[1], sort_keys[item[0]]))
+    return [(title, artist_name, cnt) for ((title, artist_name), cnt) in ranked[:n]]
+
+
+def get_most_engaged_users_sharded(
+    shards: list,
+    year_range: Tuple[int, int],
+    n: int
+) -> List[Tuple[str, int]]:
+    """Exact global top-n users; same result and tie-break as get_most_engaged_users.
+
+    Every user's ratings live on exactly one shard, so each shard's own
+    top-n is already exact and merging those n * shards rows is enough.
+    """
+    merged = []
+    for partial in _scatter(shards, _rating_counts_by_user, [(year_range, n)] * len(shards)):
+        merged.extend(partial)
+
+    merged.sort(key=lambda item: (-item[1], item[2]))
+    return [(username, cnt) for (username, cnt, _) in merged[:n]]
+
+
+# ---------------------------------------------------------
+# Approximate analytics: day and year rating sketches
+# ---------------------------------------------------------
+
+# Count-Min shape (depth rows x width counters) and Space-Saving capacity.
+# Changing either invalidates sketches already stored in RatingSketch.
+SKETCH_DEPTH = 4
+SKETCH_WIDTH = 2048
+HEAVY_HITTERS_K = 64
+
+# Counters are little-endian uint64 so year rollups cannot overflow.
+_CMS_BYTES = 8 * SKETCH_DEPTH * SKETCH_WIDTH
+
+
+class ApproximateCount(int):
+    """An estimated count that never undercounts: the true value is in [self - error, self].
+
+    This holds for ratings the sketches have seen; ratings loaded before
+    they existed need rebuild_rating_sketches() first.
+    """
+
+    def __new__(cls, value: int, error: int):
+        count = super().__new__(cls, value)
+        count.error = error
+        return count
+
+    def __repr__(self) -> str:
+        return f"{int(self)}±{self.error}"
+
+
+def _cms_cells(item_id: int) -> List[int]:
+    """Flat counter index of item_id in each Count-Min row (double hashing).
+
+    blake2b rather than hash() so the cells are the same in every process.
+    """
+    digest = hashlib.blake2b(str(item_id).encode("ascii"), digest_size=16).digest()
+    h1 = int.from_bytes(digest[:8], "little")
+    h2 = int.from_bytes(digest[8:], "little") | 1
+    return [row * SKETCH_WIDTH + (h1 + row * h2) % SKETCH_WIDTH for row in range(SKETCH_DEPTH)]
+
+
+def _cms_from_blob(blob: bytes) -> array:
+    cms = array("Q")
+    cms.frombytes(blob)
+    if sys.byteorder == "big":
+        cms.byteswap()
+    return cms
+
+
+def _cms_to_blob(cms: array) -> bytes:
+    if sys.byteorder == "big":
+        cms = array("Q", cms)
+        cms.byteswap()
+    return cms.tobytes()
+
+
+def _as_date(cur, value) -> date:
+    if isinstance(value, date):
+        return value
+    try:
+        return date.fromisoformat(str(value))
+    except ValueError:
+        # Any other format MySQL accepted for the Rating row
+        cur.execute("SELECT CAST(%s AS DATE)", (value,))
+        return cur.fetchone()[0]
+
+
+def _sketch_periods(day: date) -> List[Tuple[str, date]]:
+    """The (grain, period_start) sketches a rating on `day` counts toward.
+
+    Queries take whole years, so only the year rollups are read. The day
+    sketches are the per-day unit the approximate mode is built on and are
+    kept so finer ranges can be served later without a rebuild.
+    """
+    return [("day", day), ("year", day.replace(month=1, day=1))]
+
+
+def _space_saving_floor(summary: Dict[int, Tuple[int, int]]) -> int:
+    # A full summary may have evicted any unmonitored item with up to its
+    # smallest count; a summary that never filled up is exact.
+    if len(summary) < HEAVY_HITTERS_K:
+        return 0
+    return min(hits for hits, _ in summary.values())
+
+
+def _merge_space_saving(
+    summaries: List[Tuple[Dict[int, Tuple[int, int]], int]]
+) -> Dict[int, Tuple[int, int]]:
+    """Merge (summary, floor) pairs into one {item: (hits, error)} summary.
+
+    An item missing from a summary is charged that summary's floor in both
+    hits and error, so hits stays an upper bound and hits - error a lower
+    bound on the item's true count.
+    """
+    floor_total = sum(floor for _, floor in summaries)
+    merged: Dict[int, Tuple[int, int]] = {}
+    for summary, floor in summaries:
+        for item, (hits, error) in summary.items():
+            prev_hits, prev_error = merged.get(item, (floor_total, floor_total))
+            merged[item] = (prev_hits + hits - floor, prev_error + error - floor)
+    return merged
+
+
+def _update_rating_sketches(cur, inserted: List[Tuple[str, int, int]]) -> None:
+    """Fold newly inserted (rating_date, song_id, user_id) rows into the sketches.
+
+    Runs inside the loader's transaction, so sketches and Rating commit together.
+    """
+    counts_by_day: Dict[Tuple[str, date], Dict[int, int]] = {}
+    for rating_date, song_id, user_id in inserted:
+        day = _as_date(cur, rating_date)
+        for kind, item_id in (("song", song_id), ("user", user_id)):
+            counts = counts_by_day.setdefault((kind, day), {})
+            counts[item_id] = counts.get(item_id, 0) + 1
+    _apply_sketch_counts(cur, counts_by_day)
+
+
+def _apply_sketch_counts(cur, counts_by_day: Dict[Tuple[str, date], Dict[int, int]]) -> None:
+    """Add exact {(kind, day): {item_id: count}} to the day and year sketches.
+
+    Each sketch row stays locked until commit, so every rating loader
+    touching a given year waits on that year's row: concurrent loaders
+    for the same year run one after another.
+    """
+    batches: Dict[Tuple[str, str, date], Dict[int, int]] = {}
+    for (kind, day), counts in counts_by_day.items():
+        for grain, period_start in _sketch_periods(day):
+            batch = batches.setdefault((kind, grain, period_start), {})
+            for item_id, cnt in counts.items():
+                batch[item_id] = batch.get(item_id, 0) + cnt
+
+    # Sorted so concurrent loaders lock sketch rows in the same order.
+    for (kind, grain, period_start), counts in sorted(batches.items()):
+        key = (kind, grain, period_start)
+
+        # Create the row first so FOR UPDATE always takes a row lock: on a
+        # missing row it only gap-locks, and two loaders starting the same
+        # period would both pass and deadlock on the insert. ON DUPLICATE
+        # KEY rather than INSERT IGNORE, which would take a shared lock and
+        # deadlock on the upgrade to exclusive instead.
+        cur.execute(
+            """
+            INSERT INTO RatingSketch (kind, grain, period_start, cms)
+            VALUES (%s, %s, %s, UNHEX(REPEAT('00', %s)))
+            ON DUPLICATE KEY UPDATE cms = cms
+            """,
+            key + (_CMS_BYTES,),
+        )
+        cur.execute(
+            """
+            SELECT cms FROM RatingSketch
+            WHERE kind = %s AND grain = %s AND period_start = %s
+            FOR UPDATE
+            """,
+            key,
+        )
+        cms = _cms_from_blob(cur.fetchone()[0])
+        for item_id, cnt in counts.items():
+            for cell in _cms_cells(item_id):
+                cms[cell] += cnt
+
+        cur.execute(
+            """
+            SELECT item_id, hits, error FROM RatingHeavyHitter
+            WHERE kind = %s AND grain = %s AND period_start = %s
+            """,
+            key,
+        )
+        summary = {item_id: (int(hits), int(error)) for (item_id, hits, error) in cur.fetchall()}
+        batch = {item_id: (cnt, 0) for item_id, cnt in counts.items()}
+        merged = _merge_space_saving([(summary, _space_saving_floor(summary)), (batch, 0)])
+        top = sorted(merged.items(), key=lambda item: -item[1][0])[:HEAVY_HITTERS_K]
+
+        cur.execute(
+            """
+            UPDATE RatingSketch SET cms = %s
+            WHERE kind = %s AND grain = %s AND period_start = %s
+            """,
+            (_cms_to_blob(cms),) + key,
+        )
+        cur.execute(
+            """
+            DELETE FROM RatingHeavyHitter
+            WHERE kind = %s AND grain = %s AND period_start = %s
+            """,
+            key,
+        )
+        cur.executemany(
+            """
+            INSERT INTO RatingHeavyHitter (kind, grain, period_start, item_id, hits, error)
+            VALUES (%s, %s, %s, %s, %s, %s)
+            """,
+            [key + (item_id, hits, error) for item_id, (hits, error) in top],
+        )
+
+
+def rebuild_rating_sketches(mydb) -> None:
+    """Rebuild RatingSketch and RatingHeavyHitter from the Rating table.
+
+    Needed once for ratings loaded before the sketches existed, or after
+    they are lost. Aggregates one rating_date at a time through
+    idx_rating_date and commits per day, so memory is bounded by one day's
+    distinct songs and users. Run it with loaders stopped: a rating
+    committed mid-rebuild may be counted twice or not at all.
+    """
+    conn = _writer(mydb)
+    cur = conn.cursor()
+    try:
+        cur.execute("DELETE FROM RatingHeavyHitter")
+        cur.execute("DELETE FROM RatingSketch")
+        conn.commit()
+
+        cur.execute("SELECT DISTINCT rating_date FROM Rating ORDER BY rating_date")
+        days = [day for (day,) in cur.fetchall()]
+        for day in days:
+            counts_by_day = {}
+            for kind, column in (("song", "song_id"), ("user", "user_id")):
+                cur.execute(
+                    f"""
+                    SELECT {column}, COUNT(*) FROM Rating
+                    WHERE rating_date = %s
+                    GROUP BY {column}
+                    """,
+                    (day,),
+                )
+                counts_by_day[(kind, day)] = {item_id: int(cnt) for (item_id, cnt) in cur.fetchall()}
+            _apply_sketch_counts(cur, counts_by_day)
+            conn.commit()
+        _note_write(mydb)
+    finally:
+        cur.close()
+
+
+def _approximate_top_items(
+    conn,
+    kind: str,
+    year_range: Tuple[int, int],
+) -> Dict[int, ApproximateCount]:
+    """Merge the `kind` sketches covering year_range into per-item estimates.
+
+    The heavy hitters are read first; they are the candidates, and any item
+    with more than 1 / HEAVY_HITTERS_K of a period's ratings is kept for that
+    period. The Count-Min bound is then read only at those candidates' cells.
+    Each estimate is the tighter of the two upper bounds, with error down to
+    the Space-Saving lower bound.
+    """
+    # Clamped so any range the exact path accepts maps onto real dates
+    start_year = max(year_range[0], date.min.year)
+    end_year = min(year_range[1], date.max.year)
+    if start_year > end_year:
+        return {}
+    params = (kind, date(start_year, 1, 1), date(end_year, 1, 1))
+
+    cur = conn.cursor()
+    try:
+        cur.execute(
+            """
+            SELECT period_start, item_id, hits, error FROM RatingHeavyHitter
+            WHERE kind = %s AND grain = 'year' AND period_start BETWEEN %s AND %s
+            """,
+            params,
+        )
+        summaries: Dict[date, Dict[int, Tuple[int, int]]] = {}
+        for period_start, item_id, hits, error in cur.fetchall():
+            summaries.setdefault(period_start, {})[item_id] = (int(hits), int(error))
+        merged = _merge_space_saving(
+            [(summary, _space_saving_floor(summary)) for summary in summaries.values()]
+        )
+        if not merged:
+            return {}
+
+        cur.execute(
+            """
+            SELECT cms FROM RatingSketch
+            WHERE kind = %s AND grain = 'year' AND period_start BETWEEN %s AND %s
+            """,
+            params,
+        )
+        cells = {item_id: _cms_cells(item_id) for item_id in merged}
+        row_sums = {item_id: [0] * SKETCH_DEPTH for item_id in merged}
+        for (blob,) in cur.fetchall():
+            for item_id, item_cells in cells.items():
+                sums = row_sums[item_id]
+                for row, cell in enumerate(item_cells):
+                    sums[row] += struct.unpack_from("<Q", blob, 8 * cell)[0]
+    finally:
+        cur.close()
+
+    estimates = {}
+    for item_id, (hits, error) in merged.items():
+        upper = min(hits, min(row_sums[item_id]))
+        estimates[item_id] = ApproximateCount(upper, upper - max(hits - error, 0))
+    return estimates
+
+
+def _top_n_candidates(estimates: Dict[int, ApproximateCount], n: int) -> List[int]:
+    # Everything tied with the n-th estimate is kept so the name tie-break
+    # can be applied after the lookup.
+    if n <= 0 or not estimates:
+        return []
+    cutoff = sorted(estimates.values(), reverse=True)[min(n, len(estimates)) - 1]
+    return [item_id for item_id, est in estimates.items() if est >= cutoff]
+
+
+def _approximate_most_rated_songs(
+    mydb,
+    year_range: Tuple[int, int],
+    n: int
+) -> List[Tuple[str, str, int]]:
+    # One reader for both queries so they see the same replica
+    conn = _reader(mydb)
+    estimates = _approximate_top_items(conn, "song", year_range)
+    song_ids = _top_n_candidates(estimates, n)
+    if not song_ids:
+        return []
+
+    cur = conn.cursor()
+    try:
+        placeholders = ", ".join(["%s"] * len(song_ids))
+        cur.execute(
+            f"""
+            SELECT s.song_id, s.title, a.name,
+                   WEIGHT_STRING(s.title), WEIGHT_STRING(a.name)
+            FROM Song s
+            JOIN Artist a ON s.artist_id = a.artist_id
+            WHERE s.song_id IN ({placeholders})
+            """,
+            song_ids,
+        )
+        rows = [
+            (title, artist_name, estimates[song_id], bytes(title_key), bytes(artist_key))
+            for (song_id, title, artist_name, title_key, artist_key) in cur.fetchall()
+        ]
+    finally:
+        cur.close()
+
+    # WEIGHT_STRING keys give the same collation-exact tie-break as MySQL
+    rows.sort(key=lambda row: (-row[2], row[3], row[4]))
+    return [(title, artist_name, cnt) for (title, artist_name, cnt, _, _) in rows[:n]]
+
+
+def _approximate_most_engaged_users(
+    mydb,
+    year_range: Tuple[int, int],
+    n: int
+) -> List[Tuple[str, int]]:
+    conn = _reader(mydb)
+    estimates = _approximate_top_items(conn, "user", year_range)
+    user_ids = _top_n_candidates(estimates, n)
+    if not user_ids:
+        return []
+
+    cur = conn.cursor()
+    try:
+        placeholders = ", ".join(["%s"] * len(user_ids))
+        cur.execute(
+            f"""
+            SELECT user_id, username, WEIGHT_STRING(username)
+            FROM `User`
+            WHERE user_id IN ({placeholders})
+            """,
+            user_ids,
+        )
+        rows = [
+            (username, estimates[user_id], bytes(key))
+            for (user_id, username, key) in cur.fetchall()
+        ]
+    finally:
+        cur.close()
+
+    rows.sort(key=lambda row: (-row[1], row[2]))
+    return [(username, cnt) for (username, cnt, _) in rows[:n]]
+
+
+STARTUP_PROFILE["module_import_s"] = time.perf_counter() - _MODULE_IMPORT_STARTED
@@ -3,7 +3,12 @@
 ---USE sab541_music_db;
 
 SET FOREIGN_KEY_CHECKS = 0;
+DROP TABLE IF EXISTS ChangeSequence;
+DROP TABLE IF EXISTS ChangeLog;
+DROP TABLE IF EXISTS RatingHeavyHitter;
+DROP TABLE IF EXISTS RatingSketch;
 DROP TABLE IF EXISTS Rating;
+DROP TABLE IF EXISTS GenreSongCount;
 DROP TABLE IF EXISTS SongGenre;
 DROP TABLE IF EXISTS Song;
 DROP TABLE IF EXISTS Album;
@@ -91,6 +96,22 @@ CREATE TABLE SongGenre (
         ON UPDATE CASCADE
 ) ;
 
+-- Songs per genre, maintained by the loaders alongside SongGenre so that
+-- get_top_song_genres() reads n index entries instead of aggregating.
+CREATE TABLE GenreSongCount (
+    genre_id   SMALLINT UNSIGNED PRIMARY KEY,
+    name       VARCHAR(80) NOT NULL,
+    song_count INT UNSIGNED NOT NULL DEFAULT 0,
+
+    INDEX idx_genre_song_count_top (song_count DESC, name),
+
+    CONSTRAINT fk_genresongcount_genre
+        FOREIGN KEY (genre_id)
+        REFERENCES Genre(genre_id)
+        ON DELETE CASCADE
+        ON UPDATE CASCADE
+) ;
+
 CREATE TABLE Rating (
     rating_id    BIGINT UNSIGNED AUTO_INCREMENT PRIMARY KEY,
     user_id      INT UNSIGNED NOT NULL,
@@ -99,6 +120,7 @@ CREATE TABLE Rating (
     rating_date  DATE NOT NULL,
 
     UNIQUE KEY uq_user_song (user_id, song_id),
+    INDEX idx_rating_date (rating_date),
 
     CONSTRAINT fk_rating_user
         FOREIGN KEY (user_id)
@@ -115,3 +137,47 @@ CREATE TABLE Rating (
     CONSTRAINT chk_rating_value
         CHECK (rating_value BETWEEN 1 AND 5)
 ) ;
+
+-- Append-only change feed: one row per Song/Album/Rating inserted by a loader,
+-- plus a 'Reset' row (row_id 0) whenever clear_database() runs.
+-- change_id is the watermark downstream consumers pass to changes_since().
+CREATE TABLE ChangeLog (
+    change_id  BIGINT UNSIGNED PRIMARY KEY,
+    table_name ENUM('Song', 'Album', 'Rating', 'Reset') NOT NULL,
+    row_id     BIGINT UNSIGNED NOT NULL
+) ;
+
+-- Single-row counter that hands out change_ids in commit order; loaders hold
+-- its row lock from taking ids until they commit. Never truncated.
+CREATE TABLE ChangeSequence (
+    id             TINYINT UNSIGNED PRIMARY KEY,
+    next_change_id BIGINT UNSIGNED NOT NULL
+) ;
+
+INSERT INTO ChangeSequence (id, next_change_id) VALUES (1, 1);
+
+-- Rating sketches for the approximate get_most_rated_songs /
+-- get_most_engaged_users mode: one per kind ('song' or 'user'), grain and
+-- period. Loaders update the day sketch and its year rollup together;
+-- queries read the year rollups.
+-- cms is a SKETCH_DEPTH x SKETCH_WIDTH Count-Min array of little-endian
+-- uint64 counters; RatingHeavyHitter holds that period's Space-Saving summary.
+CREATE TABLE RatingSketch (
+    kind         ENUM('song', 'user') NOT NULL,
+    grain        ENUM('day', 'year') NOT NULL,
+    period_start DATE NOT NULL,
+    cms          MEDIUMBLOB NOT NULL,
+
+    PRIMARY KEY (kind, grain, period_start)
+) ;
+
+CREATE TABLE RatingHeavyHitter (
+    kind         ENUM('song', 'user') NOT NULL,
+    grain        ENUM('day', 'year') NOT NULL,
+    period_start DATE NOT NULL,
+    item_id      INT UNSIGNED NOT NULL,
+    hits         BIGINT UNSIGNED NOT NULL,
+    error        BIGINT UNSIGNED NOT NULL,
+
+    PRIMARY KEY (kind, grain, period_start, item_id)
+) ;